@@ -1,7 +1,113 @@
-from pathlib import Path
-from sortedcontainers import SortedList
-from fractional_indexing import generate_key_between
-from fastcore.utils import *
+import os, time
+from bisect import bisect_left, bisect_right, insort
+from fractional_indexing import FIError, BASE_62_DIGITS
+
+## Key generation
+
+"""
+generate_key_between() and generate_n_keys_between() replace those in `fractional_indexing` for its default base-62
+digits only: they take no `digits=` parameter. For base-62 keys they produce the same keys and raise the same FIErrors.
+Digit values come from a lookup table instead of `str.index`, carries are done with string strips, and midpoints use
+integer arithmetic instead of `decimal` rounding.
+"""
+
+class _DigitValues(dict):
+    "Maps base-62 digits to their values; like `str.index`, raises ValueError for other characters"
+    def __missing__(self, c): raise ValueError(f'{c!r} is not a base-62 digit')
+
+_DIGIT_VAL = _DigitValues((c,i) for i,c in enumerate(BASE_62_DIGITS))
+_SMALLEST_INT = 'A' + '0'*26
+
+def _int_len(head):
+    "Length of the integer part of a key starting with head"
+    if 'a' <= head <= 'z': return ord(head) - 95 # 'a' -> 2
+    if 'A' <= head <= 'Z': return 92 - ord(head) # 'Z' -> 2
+    raise FIError('invalid order key head: ' + head)
+
+def _validate_order_key(key):
+    n = _int_len(key[0])
+    if key == _SMALLEST_INT or n > len(key) or (len(key) > n and key[-1] == '0'):
+        raise FIError(f'invalid order key: {key}')
+
+def _midpoint(a, b):
+    "A fraction between fractions a and b (None for the end), neither with trailing zeros"
+    prefix = ''
+    if b:
+        n = 0
+        for x, y in zip(a.ljust(len(b), '0'), b):
+            if x != y: break
+            n += 1
+        if n: prefix, a, b = b[:n], a[n:], b[n:]
+    while True:
+        da = _DIGIT_VAL[a[0]] if a else 0
+        db = 62 if b is None else _DIGIT_VAL[b[0]]
+        if db - da > 1: return prefix + BASE_62_DIGITS[(da + db + 1)//2]
+        if b is not None and len(b) > 1: return prefix + b[0]
+        prefix, a, b = prefix + BASE_62_DIGITS[da], a[1:], None
+
+def _increment_integer(x):
+    head, digs = x[0], x[1:]
+    rest = digs.rstrip('z')
+    if rest: return head + rest[:-1] + BASE_62_DIGITS[_DIGIT_VAL[rest[-1]] + 1] + '0'*(len(digs) - len(rest))
+    if head == 'Z': return 'a0'
+    if head == 'z': return None
+    h = chr(ord(head) + 1)
+    return h + '0'*(len(digs) + (1 if h > 'a' else -1))
+
+def _decrement_integer(x):
+    head, digs = x[0], x[1:]
+    rest = digs.rstrip('0')
+    if rest: return head + rest[:-1] + BASE_62_DIGITS[_DIGIT_VAL[rest[-1]] - 1] + 'z'*(len(digs) - len(rest))
+    if head == 'a': return 'Zz'
+    if head == 'A': return None
+    h = chr(ord(head) - 1)
+    return h + 'z'*(len(digs) + (1 if h < 'Z' else -1))
+
+def generate_key_between(a, b):
+    "A key between keys a and b, where None is the start (for a) or end (for b)"
+    if a is not None: _validate_order_key(a)
+    if b is not None: _validate_order_key(b)
+    if a is not None and b is not None and a >= b: raise FIError(f'{a} >= {b}')
+    if a is None:
+        if b is None: return 'a0'
+        ib = b[:_int_len(b[0])]
+        if ib == _SMALLEST_INT: return ib + _midpoint('', b[len(ib):])
+        if ib < b: return ib
+        res = _decrement_integer(ib)
+        if res is None: raise FIError('cannot decrement any more')
+        return res
+    ia = a[:_int_len(a[0])]
+    fa = a[len(ia):]
+    if b is None:
+        i = _increment_integer(ia)
+        return ia + _midpoint(fa, None) if i is None else i
+    ib = b[:_int_len(b[0])]
+    if ia == ib: return ia + _midpoint(fa, b[len(ib):])
+    i = _increment_integer(ia)
+    if i is None: raise FIError('cannot increment any more')
+    return i if i < b else ia + _midpoint(fa, None)
+
+def generate_n_keys_between(a, b, n):
+    "A sorted list of n distinct keys between keys a and b, where None is the start (for a) or end (for b)"
+    if n == 0: return []
+    if n == 1: return [generate_key_between(a, b)]
+    if b is None:
+        c = generate_key_between(a, b)
+        res = [c]
+        for _ in range(n-1):
+            c = generate_key_between(c, b)
+            res.append(c)
+        return res
+    if a is None:
+        c = generate_key_between(a, b)
+        res = [c]
+        for _ in range(n-1):
+            c = generate_key_between(a, c)
+            res.append(c)
+        return res[::-1]
+    mid = n//2
+    c = generate_key_between(a, b)
+    return [*generate_n_keys_between(a, c, mid), c, *generate_n_keys_between(c, b, n-mid-1)]
 
 class Indexer:
     """
@@ -11,9 +117,10 @@ class Indexer:
 
     The user might choose to add the item with a NAME derived from the KEY.
     """
+    __slots__ = ('items','name_to_key')
     def __init__(self,
                  accessor,                # provides index accessors for the resource
-                 name_to_key = lambda x:x # maps resource item NAMEs to KEYs
+                 name_to_key = None       # maps resource item NAMEs to KEYs; None if NAMEs are KEYs
                  ):
         self.items = accessor
         self.name_to_key = name_to_key
@@ -22,15 +129,44 @@ class Indexer:
                after=None, # NAME to insert after
                before=None # NAME to insert before
                ):
-        match (after, before):
-            case (None, None):  after  = self.items.last()
-            case (None, _):     after  = self.items.before(before)
-            case (_, None):     before = self.items.after(after)
-        return generate_key_between(self.name_to_key(after), self.name_to_key(before))
+        if after is None:
+            if before is None: after = self.items.last()
+            else:              after = self.items.before(before)
+        elif before is None:   before = self.items.after(after)
+        return self._key_between(after, before)
+
+    def _key_between(self, after, before):
+        "Generates a KEY between the adjacent NAMEs after and before (either may be None)"
+        n2k = self.name_to_key
+        if n2k is None: return generate_key_between(after, before)
+        return generate_key_between(n2k(after), n2k(before))
     
-    def insert_at_start(self): return self.insert(before=self.items.first())
-    def insert_at_end(self): return self.insert(after=self.items.last())
+    # the first/last item has no neighbour beyond it, so no need to go through insert()'s lookups
+    def insert_at_start(self): return self._key_between(None, self.items.first())
+    def insert_at_end(self): return self._key_between(self.items.last(), None)
+
+    def append(self,
+               prev_key=None # KEY of the last item, if the caller knows it; looked up if None
+               ):
+        "Generates a KEY after the last item, without querying the resource when prev_key is given"
+        if prev_key is None: return self.insert_at_end()
+        return generate_key_between(prev_key, None)
+
+    def insert_many_at_end(self, n):
+        "Generates a list of n ascending KEYs after the last item, looking up the last item only once"
+        return self._keys_between(self.items.last(), None, n)
+
+    def _keys_between(self, after, before, n):
+        "Generates n ascending KEYs between the adjacent NAMEs after and before (either may be None)"
+        n2k = self.name_to_key
+        if n2k is not None: after,before = n2k(after),n2k(before)
+        return generate_n_keys_between(after, before, n)
+
     def __iter__(self):
+        # a single ordered scan of the resource, where the accessor supports it; accessors iterate over a snapshot
+        if hasattr(self.items, '__iter__'):
+            yield from self.items
+            return
         current = self.items.first()
         while current is not None:
             yield current
@@ -43,23 +179,53 @@ The Accessor methods after(),before(),first(),last() provide readonly access to
 """
 
 class SqliteAccessor:
+    """
+    Accessor for the values of a column in a sqlite table. `col` should be the PRIMARY KEY or have its own index,
+    so that each lookup is a single b-tree seek.
+    """
+    __slots__ = ('conn','table','col','index_name','_sql_first','_sql_last','_sql_before','_sql_after','_sql_all')
     def __init__(self,
                  conn, # sqlite3 connection 
                  table, # table name
-                 col='id' # column name
+                 col='id', # column name
+                 index_name=None # index on col to force with INDEXED BY, if the planner might choose another
                  ):
-        store_attr()
+        self.conn,self.table,self.col,self.index_name = conn,table,col,index_name
+        # table and col are fixed, so build the SQL once; sqlite3 then reuses its cached prepared statements
+        # NULLs sort first in SQLite, and are not items, so skip them as min()/max() would
+        self._sql_first  = self._select('ASC', f"{col} IS NOT NULL")
+        self._sql_last   = self._select('DESC', f"{col} IS NOT NULL")
+        self._sql_before = self._select('DESC', f"{col}<?")
+        self._sql_after  = self._select('ASC', f"{col}>?")
+        self._sql_all    = f"SELECT {col} FROM {self._source()} WHERE {col} IS NOT NULL ORDER BY {col}"
 
-    def fetchone(self, m, where='', params=()):
-        q = f"SELECT {m}({self.col}) FROM {self.table}"
+    def _select(self, order, where=''):
+        "SQL for the first value of col in the given order ('ASC' or 'DESC'), an index seek rather than an aggregate"
+        q = f"SELECT {self.col} FROM {self._source()}"
         if where: q += f" WHERE {where}"
-        r = self.conn.execute(q, params).fetchone()
-        return r[0] if r else None
+        return q + f" ORDER BY {self.col} {order} LIMIT 1"
+
+    def _source(self):
+        "The table to select from, with its INDEXED BY clause if index_name is set"
+        return self.table if self.index_name is None else f"{self.table} INDEXED BY {self.index_name}"
+
+    def _cursor(self):
+        "A new cursor for each call, so connections shared between threads work; rows are plain tuples, whatever the connection's row_factory"
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        return cur
+
+    def fetchone(self, q, params=()):
+        (v,) = self._cursor().execute(q, params).fetchone() or (None,)
+        return v
 
-    def first(self): return self.fetchone('min')
-    def last(self): return self.fetchone('max')
-    def before(self, item): return self.fetchone('max', f"{self.col}<?", (item,))
-    def after(self, item): return self.fetchone('min', f"{self.col}>?", (item,))
+    def first(self): return self.fetchone(self._sql_first)
+    def last(self): return self.fetchone(self._sql_last)
+    def before(self, item): return self.fetchone(self._sql_before, (item,))
+    def after(self, item): return self.fetchone(self._sql_after, (item,))
+    def __iter__(self):
+        # fetch all rows up front: results of a lazy cursor are undefined if the table changes while iterating
+        return iter([r[0] for r in self._cursor().execute(self._sql_all).fetchall()])
 
 #
 # The following methods would be neded intead, to support
@@ -72,7 +238,7 @@ class SqliteAccessor:
     #         (sqlcond,value) = extra_where_condition
     #         cond += f' AND {sqlcond}'
     #         vars = tuple(list(vars) + [value])
-    #     return self.fetchone('min', cond, vars)
+    #     return self.fetchone(self._select('ASC', cond), vars)
 
     # def before(self, name, extra_where_condition=None):
     #     cond,vars = f"{self.col}<?", (name,)
@@ -80,93 +246,138 @@ class SqliteAccessor:
     #         (sqlcond,value) = extra_where_condition
     #         cond += f' AND {sqlcond}'
     #         vars = tuple(list(vars) + [value])
-    #     return self.fetchone('max', cond, vars)
+    #     return self.fetchone(self._select('DESC', cond), vars)
 
 class SqliteIndexer(Indexer):
+    __slots__ = ()
     def __init__(self, 
                  conn, 
                  table, 
                  col='id',
-                 name_to_key=lambda x:x # mapping which preserves key ordering
+                 name_to_key=None, # mapping which preserves key ordering; None if names are keys
+                 index_name=None # index on col to force with INDEXED BY
                  ):
-        super().__init__(accessor=SqliteAccessor(conn, table, col),
+        super().__init__(accessor=SqliteAccessor(conn, table, col, index_name),
                          name_to_key=name_to_key)
 
 ## Managed resource: a Python list
 
 class ManagedListIndexer(Indexer):
     "Indexer which unusually owns and manages its resource, a Python list. Mainly, an implementation helper"
-    def __init__(self,keys=[]):
-        self.lst = ManagedListAccessor(keys)
+    __slots__ = ('lst',)
+    def __init__(self,keys=None):
+        self.lst = ManagedListAccessor(() if keys is None else keys)
         super().__init__(self.lst)
-    def insert(self,after=None,before=None):
-        new_idx = super().insert(after=after,before=before)
+    def _key_between(self,after,before):
+        new_idx = super()._key_between(after,before)
         self.lst.add(new_idx)
         return new_idx
+    def append(self,prev_key=None):
+        # last() is O(1) on the managed list and always current, so a caller's prev_key isn't needed
+        return self.insert_at_end()
+    def _keys_between(self,after,before,n):
+        new_idxs = super()._keys_between(after,before,n)
+        for k in new_idxs: self.lst.add(k)
+        return new_idxs
     def __getitem__(self,key): return self.lst[key]
     def __len__(self): return len(self.lst)
 
-class ManagedListAccessor(SortedList):
+class ManagedListAccessor:
     "An accessor which, unusually, owns and manages its resource, a sorted Python list."
+    __slots__ = ('_data',)
+    def __init__(self, iterable=()): self._data = sorted(iterable)
+
+    def bisect_left(self, item): return bisect_left(self._data, item)
+    def bisect_right(self, item): return bisect_right(self._data, item)
+    def add(self, item):
+        "Adds item, keeping the list sorted."
+        insort(self._data, item)
+
+    def __getitem__(self, i): return self._data[i]
+    def __len__(self): return len(self._data)
+    def __iter__(self): return iter(list(self._data)) # a copy, so inserting while iterating is safe
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, ManagedListAccessor)): return NotImplemented
+        return self._data==list(other)
+    def __repr__(self): return f"{type(self).__name__}({self._data!r})"
+
     def after(self, item):
         "Returns the next item after the specified item, or None if there is none."
-        i = self.bisect_right(item)
-        return self[i] if i<len(self) else None
+        d = self._data
+        i = bisect_right(d, item)
+        return d[i] if i<len(d) else None
 
     def before(self, item): 
         "Returns the previous item before the specified item, or None if there is none."
-        i = self.bisect_left(item)-1
-        return self[i] if i>=0 else None
+        d = self._data
+        i = bisect_left(d, item)-1
+        return d[i] if i>=0 else None
 
     def first(self):
         "Returns the first item in the list, or None if empty."
-        return self[0] if self else None
+        return self._data[0] if self._data else None
 
     def last(self):
         "Returns the last item in the list, or None if empty."
-        return self[-1] if self else None
+        return self._data[-1] if self._data else None
 
 ## External resouce: a directory of files
 
 class FileAccessor:
+    __slots__ = ('dir','name_to_key','_mtime','_scanned','_keys_arr','_names_arr')
+    # mtimes this close to the last scan are "racy": a change in the same timestamp tick (up to 2s on FAT) leaves mtime unchanged
+    _racy_ns = 2_000_000_000
     def __init__(self,
                  dir=".",               # Directory to scan for files
-                 name_to_key=lambda x:x # Returns key given a valid file name. Else, None
+                 name_to_key=None       # Returns key given a valid file name. Else, None. None if names are keys
                  ):
-        self.name_to_key=name_to_key
-        store_attr()
-
-    def _key_names(self):
-        "maps keys to valid file names in dir"
-        retval = dict()
-        names = [f.name for f in Path(self.dir).iterdir()]
-        for name in names:
-            key = self.name_to_key(name)
-            if key is not None:
-                retval[key] = name
-        return retval
-
-    def _keys(self): return ManagedListAccessor(self._key_names().keys())
-    def _k_to_n(self,k): return None if k is None else self._key_names()[k]
-    def _n_to_f_to_n(self,f,n): return self._k_to_n( f(n) )
-    
+        self.dir,self.name_to_key = dir,name_to_key
+        self._mtime = None # mtime of dir at the last scan
+        self._scanned = 0 # time of the last scan, in ns
+        self._keys_arr,self._names_arr = [],[] # sorted keys, and the name of each key's file
+
+    def _scan(self):
+        "Returns (sorted keys, names in the same order) for the valid file names in dir"
+        with os.scandir(self.dir) as it: names = [e.name for e in it]
+        n2k = self.name_to_key
+        if n2k is None:
+            # names are keys, so both are the same sorted list of names
+            names.sort()
+            return names,names
+        km = {k:n for n in names if (k:=n2k(n)) is not None}
+        ks = sorted(km)
+        return ks,list(map(km.__getitem__, ks))
+
+    def _snapshot(self):
+        "Returns (sorted keys, names in the same order), rescanning dir unless its mtime is unchanged and not racy"
+        mtime = os.stat(self.dir).st_mtime_ns
+        if mtime!=self._mtime or self._scanned-mtime < self._racy_ns:
+            self._scanned = time.time_ns()
+            self._keys_arr,self._names_arr = self._scan()
+            self._mtime = mtime
+        return self._keys_arr,self._names_arr
+
     def after(self, name):
-        in_k = self.name_to_key(name)
-        out_k = self._keys().after(in_k)
-        return None if out_k is None else self._key_names()[out_k]
+        ks,ns = self._snapshot()
+        n2k = self.name_to_key
+        i = bisect_right(ks, name if n2k is None else n2k(name))
+        return ns[i] if i<len(ns) else None
     def before(self, name):
-        in_k = self.name_to_key(name)
-        out_k = self._keys().before(in_k)
-        return None if out_k is None else self._key_names()[out_k]    
+        ks,ns = self._snapshot()
+        n2k = self.name_to_key
+        i = bisect_left(ks, name if n2k is None else n2k(name))-1
+        return ns[i] if i>=0 else None
     def first(self):
-        in_k = self._keys().first()
-        return None if in_k is None else self._key_names()[in_k]
+        ns = self._snapshot()[1]
+        return ns[0] if ns else None
     def last(self):
-        in_k = self._keys().last()
-        return None if in_k is None else self._key_names()[in_k]
+        ns = self._snapshot()[1]
+        return ns[-1] if ns else None
+    def __iter__(self): return iter(self._snapshot()[1])
     
 class FileIndexer(Indexer):
-    def __init__(self, dir=".", name_to_key=lambda x:x):
+    __slots__ = ()
+    def __init__(self, dir=".", name_to_key=None):
         accessor = FileAccessor(dir, name_to_key)
         super().__init__(accessor=accessor, name_to_key=name_to_key)
 
@@ -1,5 +1,5 @@
 from fastcore.utils import *
-import sqlite3, tempfile
+import os, sqlite3, tempfile, pytest
 from pathlib import Path
 from fractionalindex.fractionalindex import *
 
@@ -21,6 +21,8 @@ def test_managed_list_indexer():
     i6 = idx.insert_at_start()
     assert i6<i1
     assert idx.items == [i6, i1, i3, i4, i2, i5]
+    assert idx.items == (i6, i1, i3, i4, i2, i5) and idx.items == ManagedListIndexer(idx.items).items
+    assert idx.items != None and idx.items != 5
 
 def _test_indexer(idx,
                   add_func=noop # takes a key, creates the item, returns its name 
@@ -120,6 +122,10 @@ def _test_indexer_with_initial_names(idx, initial_names, add_func=noop):
     i7 = idx.insert(initial_names[1], initial_names[2])
     assert i7>initial_names[1] and i7<initial_names[2]
     add_func(i7)
+    i8s = idx.insert_many_at_end(3)
+    assert len(i8s)==3 and i2<i8s[0]<i8s[1]<i8s[2]
+    for i in i8s: add_func(i)
+    assert idx.insert_at_end()>i8s[-1]
 
 def test_managed_list_with_initial_names():
     "Initializing a managed list indexer with a list"
@@ -127,3 +133,168 @@ def test_managed_list_with_initial_names():
     idx = ManagedListIndexer(nms)
     _test_indexer_with_initial_names(idx, sorted(nms))
 
+
+def test_file_accessor_cache():
+    "The directory is only rescanned when its contents change, or its mtime is too recent to trust"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        d = Path(tmpdir)
+        for nm in ['a0','a1','a2']: (d/nm).touch()
+        acc = FileAccessor(d)
+        assert acc._scan()==(['a0','a1','a2'],)*2
+        assert acc.after('a0')=='a1'
+        # a change within the same mtime tick as the scan, as on a coarse-timestamp filesystem
+        mtime = os.stat(d).st_mtime_ns
+        (d/'a3').touch()
+        os.utime(d, ns=(mtime, mtime))
+        assert acc.last()=='a3'
+        old = mtime - 10*10**9
+        os.utime(d, ns=(old, old))
+        ks,ns = acc._snapshot()
+        assert acc._snapshot()[0] is ks
+        (d/'a1').unlink()
+        assert acc.after('a0')=='a2'
+        (d/'a4').touch()
+        assert acc.last()=='a4'
+
+def test_sqlite_accessor_uses_index():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO test (id) VALUES (?)", [('a0',),('a1',),('a2',)])
+    acc = SqliteAccessor(conn, 'test')
+    assert (acc.first(),acc.last()) == ('a0','a2')
+    assert (acc.before('a1'),acc.after('a1')) == ('a0','a2')
+    assert acc.before('a0') is None and acc.after('a2') is None
+    qs = []
+    conn.set_trace_callback(qs.append)
+    acc.after('a0')
+    conn.set_trace_callback(None)
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {qs[-1]}").fetchall()
+    assert 'USING COVERING INDEX' in plan[0][-1]
+
+def test_iter_single_query():
+    "Iterating a SqliteIndexer runs one ordered query, not one per item"
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    nms = ['a0','a1','a2','a3']
+    conn.executemany("INSERT INTO test (id) VALUES (?)", [(n,) for n in reversed(nms)])
+    idx = SqliteIndexer(conn, 'test')
+    qs = []
+    conn.set_trace_callback(qs.append)
+    assert list(idx)==nms
+    assert len(qs)==1
+
+def test_sqlite_accessor_row_factory():
+    "Lookups return plain values even when the connection uses a custom row_factory"
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = lambda cur,row: {'row':row}
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO test (id) VALUES (?)", [('a0',),('a1',)])
+    acc = SqliteAccessor(conn, 'test')
+    assert (acc.first(), acc.after('a0'), acc.after('a1')) == ('a0','a1',None)
+    assert list(acc) == ['a0','a1']
+
+def test_sqlite_insert_many_at_end():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    idx = SqliteIndexer(conn, table='test', col='id', name_to_key=lambda n: n and n.split('-')[1])
+    conn.execute("INSERT INTO test (id) VALUES ('msg-a5')")
+    keys = idx.insert_many_at_end(3)
+    assert keys == ['a6','a7','a8']
+    assert idx.insert_many_at_end(0) == []
+
+def test_generate_key_between_matches_fractional_indexing():
+    import random, fractional_indexing as fi
+    def check(f, g, *args):
+        try: r1 = f(*args)
+        except (fi.FIError, ValueError) as e: r1 = type(e), str(e) if isinstance(e, fi.FIError) else None
+        try: r2 = g(*args)
+        except (fi.FIError, ValueError) as e: r2 = type(e), str(e) if isinstance(e, fi.FIError) else None
+        assert r1==r2, args
+        return r1
+    random.seed(0)
+    keys = ['a0']
+    for _ in range(2000):
+        i = random.randrange(-1, len(keys))
+        a,b = (None,keys[0]) if i<0 else (keys[i], keys[i+1] if i+1<len(keys) else None)
+        keys.insert(i+1, check(fi.generate_key_between, generate_key_between, a, b))
+    assert keys==sorted(keys)
+    edge = ['a0','az','Zz','b00','bzz','a0V','a00','a0!','y'+'z'*25,'z'+'z'*26,'A'+'0'*26,'A'+'0'*25+'1','A'+'z'*26, None]
+    for a in edge:
+        for b in edge: check(fi.generate_key_between, generate_key_between, a, b)
+    for n in (0,1,7): check(fi.generate_n_keys_between, generate_n_keys_between, 'a0', 'a1', n)
+
+def test_managed_list_indexers_independent():
+    "Indexers created without keys don't share a list, and don't modify the keys they were given"
+    nms = ['a0']
+    a,b,c = ManagedListIndexer(),ManagedListIndexer(),ManagedListIndexer(nms)
+    a.insert()
+    c.insert()
+    assert len(a)==1 and len(b)==0 and len(c)==2 and nms==['a0']
+
+def test_append_with_prev_key():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    idx = SqliteIndexer(conn, table='test', col='id', name_to_key=lambda n: n and n.split('-')[1])
+    assert idx.append()=='a0'
+    conn.execute("INSERT INTO test (id) VALUES ('msg-a0')")
+    assert idx.append()=='a1'
+    qs = []
+    conn.set_trace_callback(qs.append)
+    assert idx.append('a1')=='a2'
+    assert not qs
+    lst = ManagedListIndexer(['a0','a1'])
+    assert lst.append('a0')=='a2' and list(lst)==['a0','a1','a2']
+
+def test_sqlite_indexer_indexed_by():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT, pos TEXT)")
+    conn.execute("CREATE INDEX test_pos ON test (pos)")
+    idx = SqliteIndexer(conn, table='test', col='pos', index_name='test_pos')
+    assert 'INDEXED BY test_pos' in idx.items._sql_after
+    def add_record(key):
+        conn.execute("INSERT INTO test (id,pos) VALUES ('x',?)", (key,))
+        return key
+    _test_indexer(idx, add_record)
+    with pytest.raises(sqlite3.OperationalError):
+        SqliteIndexer(conn, table='test', col='pos', index_name='missing').insert()
+
+def test_sqlite_indexer_skips_nulls():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT, pos TEXT)")
+    conn.executemany("INSERT INTO test (id,pos) VALUES ('x',?)", [(None,),('a0',),('a1',)])
+    idx = SqliteIndexer(conn, table='test', col='pos')
+    assert (idx.items.first(), idx.items.last()) == ('a0','a1')
+    assert idx.insert_at_start()=='Zz'
+    assert idx.insert_at_end()=='a2'
+    assert list(idx)==['a0','a1']
+
+def test_iter_while_modifying():
+    "Iteration sees the resource as it was when iteration started"
+    idx = ManagedListIndexer(['a0','a1'])
+    seen = []
+    for k in idx:
+        seen.append(k)
+        idx.insert(before=k)
+    assert seen==['a0','a1'] and len(idx)==4
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO test (id) VALUES (?)", [('a0',),('a1',),('a2',)])
+    sidx = SqliteIndexer(conn, 'test')
+    seen = []
+    for k in sidx:
+        seen.append(k)
+        if k=='a0': conn.execute("DELETE FROM test WHERE id='a1'")
+        assert sidx.items.after('a0')=='a2'
+    assert seen==['a0','a1','a2']
+
+def test_sqlite_indexer_threads():
+    "Lookups from several threads sharing one connection don't interfere"
+    from concurrent.futures import ThreadPoolExecutor
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.execute("CREATE TABLE test (id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO test (id) VALUES (?)", [('a0',),('a1',),('a2',)])
+    idx = SqliteIndexer(conn, 'test')
+    def work(_):
+        for _ in range(300):
+            assert idx.insert()=='a3' and idx.insert(after='a0')=='a0V' and list(idx)==['a0','a1','a2']
+    with ThreadPoolExecutor(4) as ex: list(ex.map(work, range(4)))